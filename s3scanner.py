@@ -26,6 +26,17 @@ class CustomFormatter(argparse.RawTextHelpFormatter, argparse.RawDescriptionHelp
     pass
 
 
+def positiveInt(value):
+    """ argparse type for counts that must be at least 1 """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid int value: '" + value + "'")
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got " + value)
+    return number
+
+
 # Instantiate the parser
 parser = argparse.ArgumentParser(description='#  s3scanner - Find S3 buckets and dump!\n'
                                              '#\n'
@@ -41,6 +52,8 @@ parser.add_argument('-d', '--dump', dest='dump', action='store_true', default=Fa
                     help='Dump all found open buckets locally')
 parser.add_argument('-l', '--list', dest='list', action='store_true',
                     help='Save bucket file listing to local file: ./list-buckets/${bucket}.txt')
+parser.add_argument('-t', '--threads', dest='threads', type=positiveInt, default=s3.MAX_THREADS,
+                    help='Number of buckets to check at the same time (Default: ' + str(s3.MAX_THREADS) + ')')
 parser.add_argument('--version', action='version', version=CURRENT_VERSION,
                     help='Display the current version of this tool')
 parser.add_argument('buckets', help='Name of text file containing buckets to check')
@@ -83,6 +96,8 @@ fieldStyles = {
 coloredlogs.install(level='DEBUG', logger=slog, fmt='%(asctime)s   %(message)s',
                     level_styles=levelStyles, field_styles=fieldStyles)
 
+s3.MAX_THREADS = args.threads
+
 if not s3.checkAwsCreds():
     s3.AWS_CREDS_CONFIGURED = False
     slog.error("Warning: AWS credentials not configured. Open buckets will be shown as closed. Run:"
@@ -90,9 +105,8 @@ if not s3.checkAwsCreds():
 
 if path.isfile(args.buckets):
     with open(args.buckets, 'r') as f:
-        for line in f:
-            line = line.rstrip()            # Remove any extra whitespace
-            s3.checkBucket(line, slog, flog, args.dump, args.list)
+        # Read lazily, so checking starts right away and the list is never held in memory all at once
+        s3.checkBuckets((line.rstrip() for line in f), slog, flog, args.dump, args.list)  # rstrip extra whitespace
 else:
     # It's a single bucket
     s3.checkBucket(args.buckets, slog, flog, args.dump, args.list)
@@ -1,11 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from functools import lru_cache
+from operator import itemgetter
 import os
 import re
-import signal
-from contextlib import contextmanager
-import datetime
+import socket
+import threading
+import time
 
-import boto3
-from botocore.exceptions import ClientError, NoCredentialsError, HTTPClientError
+import botocore.session
+from botocore.exceptions import ClientError, NoCredentialsError, ReadTimeoutError, IncompleteReadError, \
+    ResponseStreamingError
 from botocore.handlers import disable_signing
 from botocore import UNSIGNED
 from botocore.client import Config
@@ -13,29 +17,93 @@ import requests
 
 
 SIZE_CHECK_TIMEOUT = 30    # How long to wait for getBucketSize to return
+MAX_THREADS = 64           # How many buckets to check at the same time
+DUMP_THREADS = 16          # How many objects are downloaded at the same time, across every dumpBucket call
+DOWNLOAD_ATTEMPTS = 5      # How many times dumpBucket tries an object whose download gets cut off
+CLIENT_MAX_ATTEMPTS = 10   # How many times botocore clients try a throttled or failed request before giving up
+SLOWDOWN_RETRIES = 5       # How many times checkBucketWithoutCreds tries a bucket S3 keeps answering 503 for
+SLOWDOWN_BACKOFF = 0.5     # Seconds to wait before the first retry. Doubles before every retry after that
+CHECK_CACHE_SIZE = 4096    # How many bucket names to remember checkAcl/checkBucketWithoutCreds results for
+LIST_PAGE_SIZE = 1000      # Most keys S3 will return per list_objects_v2 call
 AWS_CREDS_CONFIGURED = True
 ERROR_CODES = ['AccessDenied', 'AllAccessDisabled', '[Errno 21] Is a directory:']
+DENIED_CODES = frozenset(['AccessDenied', 'AllAccessDisabled'])    # S3 error codes meaning we aren't allowed in
 
+# Errors reading an object's body that are worth downloading it again for. The same ones s3transfer retries
+RETRYABLE_DOWNLOAD_ERRORS = (socket.timeout, ConnectionError, ReadTimeoutError, IncompleteReadError,
+                             ResponseStreamingError)
 
-class TimeoutException(Exception): pass
+# Grantee URIs of the groups we report ACL grants for
+ALL_USERS_URI = "http://acs.amazonaws.com/groups/global/AllUsers"
+AUTH_USERS_URI = "http://acs.amazonaws.com/groups/global/AuthenticatedUsers"
+
+# Maps each group URI to its key in checkAcl's results
+GROUP_URIS = {ALL_USERS_URI: "allUsers", AUTH_USERS_URI: "authUsers"}
+
+# S3 clients created by _s3Client, keyed by whether they sign requests
+_s3Clients = {}
+_s3ClientsLock = threading.Lock()
+
+# Session checkAwsCreds found working credentials on, reused for the signed S3 client
+_credsSession = None
+
+
+# Shared by every dumpBucket call, so dumps running in checkBuckets' threads can't multiply the download threads
+_downloadExecutor = ThreadPoolExecutor(max_workers=DUMP_THREADS)
+
+
+class _ThrottledException(Exception): pass
+
+
+def _clientConfig(**kwargs):
+    """ Config for every botocore client we create: adaptive retries that back off when S3 throttles us (503
+    SlowDown) instead of failing the check, and a per-host connection pool of DUMP_THREADS.
+    Every bucket is its own host and botocore only keeps 10 host pools, so with many buckets being checked at once a
+    bucket's pool is usually gone by its next call. The pool size only matters for dumps, where DUMP_THREADS
+    downloads can be going to the same bucket at once """
+    return Config(max_pool_connections=DUMP_THREADS,
+                  retries={'max_attempts': CLIENT_MAX_ATTEMPTS, 'mode': 'adaptive'}, **kwargs)
+
+
+def _s3Client():
+    """
+    Gets the shared S3 client, creating it on first use. Creating a client means re-reading the AWS config and
+    loading endpoint data, so everything, including every thread in checkBuckets' pool, shares one client per
+    signing mode. Clients are thread-safe but botocore sessions aren't, so each is built under a lock, on a session
+    of its own. The signed client reuses checkAwsCreds' session, if it ran, rather than resolving credentials again.
+    Clients are unsigned when no AWS credentials are configured.
+    """
+    signed = AWS_CREDS_CONFIGURED is not False
+    with _s3ClientsLock:
+        if signed not in _s3Clients:
+            if signed and _credsSession is not None:
+                session = _credsSession
+            else:
+                session = botocore.session.get_session()
+            if signed:
+                _s3Clients[signed] = session.create_client('s3', config=_clientConfig())
+            else:
+                _s3Clients[signed] = session.create_client('s3', config=_clientConfig(signature_version=UNSIGNED))
+        return _s3Clients[signed]
 
-@contextmanager
-def time_limit(seconds):
-    def signal_handler(signum, frame):
-        raise TimeoutException("Timed out!")
-    signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(seconds)
-    try:
-        yield
-    finally:
-        signal.alarm(0)
 
+def _errorCode(e):
+    """ Gets the S3 error code (e.g. 'AccessDenied') out of a ClientError, or None if the response doesn't have one """
+    return e.response.get('Error', {}).get('Code')
 
 
+def _listObjectPages(s3, bucketName):
+    """ Paginates list_objects_v2 asking for the largest page S3 allows, rather than relying on the server default """
+    return s3.get_paginator("list_objects_v2").paginate(Bucket=bucketName,
+                                                        PaginationConfig={'PageSize': LIST_PAGE_SIZE})
+
+
+@lru_cache(maxsize=CHECK_CACHE_SIZE)
 def checkAcl(bucket):
     """
     Attempts to retrieve a bucket's ACL. This also functions as the main 'check if bucket exists' function.
-    By trying to get the ACL, we combine 2 steps to minimize potentially slow network calls.
+    By trying to get the ACL, we combine 2 steps to minimize potentially slow network calls. Results are cached per
+    bucket name, since different inputs (domain, full S3 url, bucket:region) often resolve to the same bucket.
 
     :param bucket: Name of bucket to try to get the ACL of
     :return: A dictionary with 2 entries:
@@ -43,33 +111,28 @@ def checkAcl(bucket):
         acls - dictionary. If ACL was retrieved, contains 2 keys: 'allUsers' and 'authUsers'. If ACL was not
                             retrieved,
     """
-    allUsersGrants = []
-    authUsersGrants = []
+    acls = {"allUsers": [], "authUsers": []}
 
-    s3 = boto3.resource('s3')
+    s3 = _s3Client()
 
     try:
-        bucket_acl = s3.BucketAcl(bucket)
-        bucket_acl.load()
-    except s3.meta.client.exceptions.NoSuchBucket:
+        bucket_acl = s3.get_bucket_acl(Bucket=bucket)
+    except s3.exceptions.NoSuchBucket:
         return {"found": False, "acls": {}}
 
     except ClientError as e:
-        if e.response['Error']['Code'] == "AccessDenied":
-            return {"found": True, "acls": "AccessDenied"}
-        elif e.response['Error']['Code'] == "AllAccessDisabled":
-            return {"found": True, "acls": "AllAccessDisabled"}
+        code = _errorCode(e)
+        if code in DENIED_CODES:
+            return {"found": True, "acls": code}
         else:
             raise e
 
-    for grant in bucket_acl.grants:
-        if 'URI' in grant['Grantee']:
-            if grant['Grantee']['URI'] == "http://acs.amazonaws.com/groups/global/AllUsers":
-                allUsersGrants.append(grant['Permission'])
-            elif grant['Grantee']['URI'] == "http://acs.amazonaws.com/groups/global/AuthenticatedUsers":
-                authUsersGrants.append(grant['Permission'])
+    for grant in bucket_acl.get('Grants', []):    # S3 may leave Grants out when there are none
+        group = GROUP_URIS.get(grant['Grantee'].get('URI'))
+        if group is not None:
+            acls[group].append(grant['Permission'])
 
-    return {"found": True, "acls": {"allUsers": allUsersGrants, "authUsers": authUsersGrants}}
+    return {"found": True, "acls": acls}
 
 
 def checkAwsCreds():
@@ -80,28 +143,27 @@ def checkAwsCreds():
     :return: True if AWS credentials are properly configured. False if not.
     """
 
-    sts = boto3.client('sts')
+    global _credsSession
+
+    session = botocore.session.get_session()
+
+    # Walk the credential chain once. If it comes up empty there's no point asking STS
+    creds = session.get_credentials()
+    if creds is None or creds.access_key is None:
+        return False
+
+    sts = session.create_client('sts', config=_clientConfig())
     try:
         response = sts.get_caller_identity()
     except NoCredentialsError as e:
             return False
 
+    _credsSession = session    # Already holds the resolved credentials, so _s3Client builds on it
     return True
 
 
 def checkBucket(inBucket, slog, flog, argsDump, argsList):
-    # Determine what kind of input we're given. Options:
-    #   bucket name   i.e. mybucket
-    #   domain name   i.e. flaws.cloud
-    #   full S3 url   i.e. flaws.cloud.s3-us-west-2.amazonaws.com
-    #   bucket:region i.e. flaws.cloud:us-west-2
-    
-    if ".amazonaws.com" in inBucket:    # We were given a full s3 url
-        bucket = inBucket[:inBucket.rfind(".s3")]
-    elif ":" in inBucket:               # We were given a bucket in 'bucket:region' format
-        bucket = inBucket.split(":")[0]
-    else:                           # We were either given a bucket name or domain name
-        bucket = inBucket
+    bucket = parseBucketName(inBucket)
 
     valid = checkBucketName(bucket)
 
@@ -115,28 +177,80 @@ def checkBucket(inBucket, slog, flog, argsDump, argsList):
         b = checkAcl(bucket)
     else:
         a = checkBucketWithoutCreds(bucket)
+        if a is None:
+            message = "{0:>11} : {1}".format("[throttled]", bucket + " | S3 kept answering 503, try again later")
+            slog.warning(message)
+            return
         b = {"found": a, "acls": "unknown - no aws creds"}
 
     if b["found"]:
 
+        # Sized only once we know the bucket exists, rather than alongside the existence/ACL check. Most names in a
+        # scan don't exist, so probing both at once would double S3 requests (and throttling) to save one round trip
         size = getBucketSize(bucket)  # Try to get the size of the bucket
 
         message = "{0:>11} : {1}".format("[found]", bucket + " | " + str(size) + " | ACLs: " + str(b["acls"]))
         slog.info(message)
         flog.debug(bucket)
 
-        if argsDump:
-            if size not in ["AccessDenied", "AllAccessDisabled"]:
-                slog.info("{0:>11} : {1} - {2}".format("[found]", bucket, "Attempting to dump...this may take a while."))
-                dumpBucket(bucket)
-        if argsList:
-            if str(b["acls"]) not in ["AccessDenied", "AllAccessDisabled"]:
-                listBucket(bucket)
+        # getBucketSize already tried listing the bucket, so don't spend more calls on one we know we can't list.
+        # Whether we could read the ACL says nothing about whether we can list objects.
+        listable = size not in DENIED_CODES and size != "NoSuchBucket"
+
+        if argsDump and listable:
+            slog.info("{0:>11} : {1} - {2}".format("[found]", bucket, "Attempting to dump...this may take a while."))
+            dumpBucket(bucket)
+        if argsList and listable:
+            listBucket(bucket)
     else:
         message = "{0:>11} : {1}".format("[not found]", bucket)
         slog.error(message)
 
 
+def checkBuckets(buckets, slog, flog, argsDump, argsList):
+    """
+    Checks many buckets at once. Every check is a few blocking network calls that spend nearly all their time
+    waiting on S3, so they're run in a pool of MAX_THREADS threads to overlap the round trips. Only a couple of
+    checks per thread are queued at a time, so stopping (an error in a check, or Ctrl-C) doesn't have to wait for
+    the rest of the bucket list to go through first.
+    Inputs naming a bucket that was already checked (e.g. flaws.cloud and flaws.cloud:us-west-2) are skipped, so
+    two threads never dump or list the same bucket at once.
+
+    :param buckets: Iterable of buckets in any of the formats accepted by checkBucket
+    :return: None
+    """
+    executor = ThreadPoolExecutor(max_workers=MAX_THREADS)
+    pending = set()
+    seen = set()    # Bucket names already submitted
+    try:
+        for b in buckets:
+            bucket = parseBucketName(b)
+            if bucket in seen:
+                continue
+            seen.add(bucket)
+
+            if len(pending) >= 2 * MAX_THREADS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()    # Re-raise anything that went wrong in a worker
+            pending.add(executor.submit(checkBucket, b, slog, flog, argsDump, argsList))
+
+        for future in as_completed(pending):
+            future.result()
+    except BaseException as e:
+        # Drop the checks that haven't started and let the running ones finish, then report any of those that
+        # failed too, since only the first error can be re-raised
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for future in pending:
+            if not future.cancelled() and future.exception() not in (None, e):
+                slog.error("{0:>11} : {1}".format("[error]", repr(future.exception())))
+        raise
+    finally:
+        executor.shutdown(wait=True)
+
+
 def checkBucketName(bucket_name):
     """ Checks to make sure bucket names input are valid according to S3 naming conventions
     :param bucketName: Name of bucket to check
@@ -151,54 +265,77 @@ def checkBucketName(bucket_name):
     return bool(re.match(pattern, bucket_name))
 
 
-def checkBucketWithoutCreds(bucketName, triesLeft=2):
+def checkBucketWithoutCreds(bucketName):
     """ Does a simple GET request with the Requests library and interprets the results.
-    bucketName - A domain name without protocol (http[s]) """
+    bucketName - A domain name without protocol (http[s])
+    Returns True/False for whether the bucket exists, or None if S3 throttled us (503) on every one of
+    SLOWDOWN_RETRIES tries, so we can't tell.
+    Found/not found results are cached per bucket name, like checkAcl's. Throttled ones aren't, so the bucket gets
+    checked again next time. """
 
-    if triesLeft == 0:
-        return False
+    try:
+        return _headBucket(bucketName)
+    except _ThrottledException:
+        return None
+
+
+@lru_cache(maxsize=CHECK_CACHE_SIZE)
+def _headBucket(bucketName):
+    """ HEADs a bucket for checkBucketWithoutCreds, raising _ThrottledException (which lru_cache won't cache) if S3
+    answers 503 to every try """
 
     bucketUrl = 'http://' + bucketName + '.s3.amazonaws.com'
 
-    r = requests.head(bucketUrl)
+    for attempt in range(SLOWDOWN_RETRIES):
+        if attempt > 0:     # S3 is throttling us. Back off exponentially before trying again
+            time.sleep(SLOWDOWN_BACKOFF * 2 ** (attempt - 1))
 
-    if r.status_code == 200:    # Successfully found a bucket!
-        return True
-    elif r.status_code == 403:  # Bucket exists, but we're not allowed to LIST it.
-        return True
-    elif r.status_code == 404:  # This is definitely not a valid bucket name.
-        return False
-    elif r.status_code == 503:
-        return checkBucketWithoutCreds(bucketName, triesLeft - 1)
-    else:
-        raise ValueError("Got an unhandled status code back: " + str(r.status_code) + " for bucket: " + bucketName +
-                         ". Please open an issue at: https://github.com/sa7mon/s3scanner/issues and include this info.")
+        r = requests.head(bucketUrl)
+
+        if r.status_code == 200:    # Successfully found a bucket!
+            return True
+        elif r.status_code == 403:  # Bucket exists, but we're not allowed to LIST it.
+            return True
+        elif r.status_code == 404:  # This is definitely not a valid bucket name.
+            return False
+        elif r.status_code != 503:
+            raise ValueError("Got an unhandled status code back: " + str(r.status_code) + " for bucket: " +
+                             bucketName + ". Please open an issue at: https://github.com/sa7mon/s3scanner/issues "
+                             "and include this info.")
+
+    raise _ThrottledException(bucketName)
 
 
 def dumpBucket(bucketName):
-    global dumped
     # Dump the bucket into bucket folder
     bucketDir = './buckets/' + bucketName
 
-    if not os.path.exists(bucketDir):
-        os.makedirs(bucketDir)
+    os.makedirs(bucketDir, exist_ok=True)
 
     dumped = True
     
-    s3 = boto3.client('s3')
+    s3 = _s3Client()
+
+    def download(key):
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            try:
+                body = s3.get_object(Bucket=bucketName, Key=key)['Body']
+                with open(bucketDir+"/"+key, 'wb') as f:
+                    for chunk in body.iter_chunks():
+                        f.write(chunk)
+                return
+            except RETRYABLE_DOWNLOAD_ERRORS:
+                if attempt == DOWNLOAD_ATTEMPTS - 1:
+                    raise
 
     try:
-        if AWS_CREDS_CONFIGURED is False:
-            s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-        
-        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucketName):
-            for item in page['Contents']:
-                key = item['Key']
-                s3.download_file(bucketName, key, bucketDir+"/"+key)
+        for page in _listObjectPages(s3, bucketName):
+            # Download a page's objects in parallel, then move on. Keeps at most one page of keys queued up
+            keys = [item['Key'] for item in page.get('Contents', [])]
+            list(_downloadExecutor.map(download, keys))    # list() re-raises anything a download hit
         dumped = True
     except ClientError as e:
-        # global dumped
-        if e.response['Error']['Code'] == 'AccessDenied':
+        if _errorCode(e) in DENIED_CODES:
             pass  # TODO: Do something with the fact that we were denied
         dumped = False
     finally:
@@ -214,33 +351,42 @@ def getBucketSize(bucketName):
     NOTE:
         Function assumes the bucket exists and doesn't catch errors if it doesn't.
     """
-    s3 = boto3.client('s3')
+    s3 = _s3Client()
     try:
-        if AWS_CREDS_CONFIGURED is False:
-            s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
         size_bytes = 0
-        with time_limit(SIZE_CHECK_TIMEOUT):
-            for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucketName):
-                for item in page['Contents']:
-                   size_bytes += item['Size']
+        # Checked before fetching each further page rather than with a SIGALRM, which only works on the main thread.
+        # Once the last page is in, the total is complete and gets returned however long it took
+        deadline = time.monotonic() + SIZE_CHECK_TIMEOUT
+        for page in _listObjectPages(s3, bucketName):
+            size_bytes += sum(map(itemgetter('Size'), page.get('Contents', [])))    # A whole page at a time
+            if page.get('IsTruncated') and time.monotonic() > deadline:
+                return "Unknown Size - timeout"
         return str(size_bytes) + " bytes"
 
-    except HTTPClientError as e:
-        if "Timed out!" in str(e):
-            return "Unknown Size - timeout"
-        else:
-            raise e
     except ClientError as e:
-        if e.response['Error']['Code'] == 'AccessDenied':
-            return "AccessDenied"
-        elif e.response['Error']['Code'] == 'AllAccessDisabled':
-            return "AllAccessDisabled"
-        elif e.response['Error']['Code'] == 'NoSuchBucket':
-            return "NoSuchBucket"
+        code = _errorCode(e)
+        if code in DENIED_CODES or code == 'NoSuchBucket':
+            return code
         else:
             raise e
 
 
+def iterBucketObjects(bucketName, s3=None):
+    """
+    Lazily lists every object in a bucket, one page of keys at a time, so huge buckets never have to be held in
+    memory all at once.
+
+    :param bucketName: Name of bucket to list
+    :param s3: Client to list with. Defaults to the shared client from _s3Client
+    :return: Generator of the object dictionaries returned by list_objects_v2 ('Key', 'LastModified', 'Size', ...)
+    """
+    if s3 is None:
+        s3 = _s3Client()
+
+    for page in _listObjectPages(s3, bucketName):
+        yield from page.get('Contents', [])
+
+
 def listBucket(bucketName):
     """ 
         If we find an open bucket, save the contents of the bucket listing to file. 
@@ -250,28 +396,39 @@ def listBucket(bucketName):
 
     # Dump the bucket into bucket folder
     bucketDir = './list-buckets/' + bucketName + '.txt'
-    if not os.path.exists('./list-buckets/'):
-        os.makedirs('./list-buckets/')
+    os.makedirs('./list-buckets/', exist_ok=True)    # Other checker threads may be creating it too
 
-    s3 = boto3.client('s3')
-    objects = []
+    partial = False    # Whether there's an unfinished listing file to clean up
 
     try:
-        if AWS_CREDS_CONFIGURED is False:
-            s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-        
-        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucketName):
-            if 'Contents' in page:
-                for item in page['Contents']:
-                    o = item['LastModified'].strftime('%Y-%m-%d %H:%M:%S') + " " + str(item['Size']) + " " + item['Key']
-                    objects.append(o)
-
+        # Write each object out as it's listed instead of collecting the whole listing first
         with open(bucketDir, 'w') as f:
-            for o in objects:
-                f.write(o + "\n")
+            partial = True
+            for item in iterBucketObjects(bucketName):
+                f.write("{0:%Y-%m-%d %H:%M:%S} {1} {2}\n".format(item['LastModified'], item['Size'], item['Key']))
+        partial = False
 
     except ClientError as e:
-        if e.response['Error']['Code'] == 'AccessDenied':
-            return "AccessDenied"
+        code = _errorCode(e)
+        if code in DENIED_CODES:
+            return code
         else:
             raise e
+    finally:
+        if partial:
+            os.remove(bucketDir)    # Don't leave a partial listing behind
+
+
+def parseBucketName(inBucket):
+    """ Gets the bucket name out of any of the input formats we accept:
+        bucket name   i.e. mybucket
+        domain name   i.e. flaws.cloud
+        full S3 url   i.e. flaws.cloud.s3-us-west-2.amazonaws.com
+        bucket:region i.e. flaws.cloud:us-west-2
+    """
+    if ".amazonaws.com" in inBucket:    # We were given a full s3 url
+        return inBucket[:inBucket.rfind(".s3")]
+    elif ":" in inBucket:               # We were given a bucket in 'bucket:region' format
+        return inBucket.split(":")[0]
+    else:                           # We were either given a bucket name or domain name
+        return inBucket
@@ -41,13 +41,14 @@ def test_arguments():
     Scenario mainargs.2: --out-file
     Scenario mainargs.3: --list
     Scenario mainargs.4: --dump
+    Scenario mainargs.5: --threads below 1 is rejected
     """
 
     test_setup()
 
     # mainargs.1
     a = subprocess.run(['python3', s3scannerLocation + 's3scanner.py'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    assert a.stderr == b'usage: s3scanner [-h] [-o OUTFILE] [-d] [-l] [--version] buckets\ns3scanner: error: the following arguments are required: buckets\n'
+    assert a.stderr == b'usage: s3scanner [-h] [-o OUTFILE] [-d] [-l] [-t THREADS] [--version] buckets\ns3scanner: error: the following arguments are required: buckets\n'
 
     # mainargs.2
 
@@ -75,6 +76,14 @@ def test_arguments():
     # mainargs.3
     # mainargs.4
 
+    # mainargs.5
+    for threads in ['0', '-1']:
+        a = subprocess.run(['python3', s3scannerLocation + 's3scanner.py', '--threads', threads, 'flaws.cloud'],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert a.returncode == 2
+        assert a.stderr.endswith(b's3scanner: error: argument -t/--threads: must be at least 1, got ' +
+                                 threads.encode() + b'\n')
+
 
 def test_checkAcl():
     """
@@ -170,17 +179,22 @@ def test_checkAwsCreds():
     # checkAwsCreds.1
     assert s3.checkAwsCreds() == credsActuallyConfigured
 
-def test_checkBucket():
+def test_checkBucket(monkeypatch):
     """
     checkBucket.1 - Bucket name
     checkBucket.2 - Domain name
     checkBucket.3 - Full s3 url
     checkBucket.4 - bucket:region
+    checkBucket.5 - --list on a bucket whose ACL can't be read (with creds) but whose objects can be listed
+        Expected: The listing file is written
+    checkBucket.6 - --list on a bucket whose objects can't be listed, without creds
+        Expected: listBucket is never called, even though the ACL wasn't denied
     """
     
     test_setup()
     
     testFile = './test/test_checkBucket.txt'
+    listFlaws = './list-buckets/flaws.cloud.txt'
     
     # Create file logger
     flog = logging.getLogger('s3scanner-file')
@@ -215,9 +229,84 @@ def test_checkBucket():
         assert results[0].rstrip() == "flaws.cloud"
         assert results[1].rstrip() == "flaws.cloud"
         assert results[2].rstrip() == "flaws.cloud"
+
+        # checkBucket.5
+        s3.checkBucket("flaws.cloud", slog, flog, False, True)
+        assert os.path.exists(listFlaws)
+
+        # checkBucket.6
+        if not s3.AWS_CREDS_CONFIGURED:     # With creds, s3scanner-private can be listed
+            listed = []
+            monkeypatch.setattr(s3, 'listBucket', listed.append)
+            s3.checkBucket("s3scanner-private", slog, flog, False, True)
+            assert listed == []
         
     finally:
-        # Delete test file
+        # Delete test files
+        os.remove(testFile)
+        if os.path.exists(listFlaws):
+            os.remove(listFlaws)
+
+def test_checkBuckets(monkeypatch):
+    """
+    checkBuckets.1 - Invalid bucket names are rejected by every worker without being logged as found
+    checkBuckets.2 - A check that raises stops the scan instead of running the rest of the list first
+    checkBuckets.3 - Inputs naming the same bucket are only checked once
+    checkBuckets.4 - Mix of a found and a not found bucket
+    """
+
+    test_setup()
+
+    testFile = './test/test_checkBuckets.txt'
+
+    flog = logging.getLogger('s3scanner-file-many')
+    flog.setLevel(logging.DEBUG)
+    fh = logging.FileHandler(testFile)
+    fh.setLevel(logging.DEBUG)
+    flog.addHandler(fh)
+
+    slog = logging.getLogger('s3scanner-screen')
+    slog.setLevel(logging.CRITICAL)
+
+    checked = []
+
+    def recordCheck(inBucket, slog, flog, argsDump, argsList):
+        checked.append(inBucket)
+        if inBucket == 'bad-bucket':
+            raise RuntimeError('check failed')
+
+    try:
+        # checkBuckets.1
+        s3.checkBuckets(['ab', 'Not_A_Bucket:dev', ''], slog, flog, False, False)
+        with open(testFile, 'r') as f:
+            assert f.readlines() == []
+
+        with monkeypatch.context() as m:
+            m.setattr(s3, 'checkBucket', recordCheck)
+
+            # checkBuckets.2
+            raised = False
+            try:
+                s3.checkBuckets(['bad-bucket'] + ['bucket-' + str(i) for i in range(100000)], slog, flog, False, False)
+            except RuntimeError:
+                raised = True
+            assert raised
+            assert len(checked) <= 3 * s3.MAX_THREADS     # Only what was queued when the error came out ran
+
+            # checkBuckets.3
+            del checked[:]
+            s3.checkBuckets(['flaws.cloud', 'flaws.cloud:us-west-2', 'flaws.cloud.s3-us-west-2.amazonaws.com',
+                             'other-bucket'], slog, flog, False, False)
+            assert sorted(checked) == ['flaws.cloud', 'other-bucket']
+
+        # checkBuckets.4
+        s3.checkBuckets(['flaws.cloud', 'ireallyhopethisbucketdoesntexist'], slog, flog, False, False)
+        with open(testFile, 'r') as f:
+            assert [l.rstrip() for l in f.readlines()] == ['flaws.cloud']
+
+    finally:
+        flog.removeHandler(fh)
+        fh.close()
         os.remove(testFile)
 
 def test_checkBucketName():
@@ -276,6 +365,55 @@ def test_checkBucketWithoutCreds():
     assert s3.checkBucketWithoutCreds('blog') is True
 
 
+def test_checkBucketWithoutCredsThrottled(monkeypatch):
+    """
+    Scenario checkBucketwcThrottled.1 - S3 answers 503 to every try
+        Expected: None (not False, which means the bucket doesn't exist), after SLOWDOWN_RETRIES HEADs
+    Scenario checkBucketwcThrottled.2 - Checking the same bucket again
+        Expected: The throttled result wasn't cached, so it gets HEADed again
+    Scenario checkBucketwcThrottled.3 - checkBucket on a bucket S3 keeps throttling
+        Expected: Logged as [throttled], not as found or not found
+    """
+    test_setup()
+
+    class ThrottledResponse:
+        status_code = 503
+
+    heads = []
+
+    def throttledHead(url):
+        heads.append(url)
+        return ThrottledResponse()
+
+    monkeypatch.setattr(s3.requests, 'head', throttledHead)
+    monkeypatch.setattr(s3, 'SLOWDOWN_BACKOFF', 0)
+    monkeypatch.setattr(s3, 'AWS_CREDS_CONFIGURED', False)
+
+    # checkBucketwcThrottled.1
+    assert s3.checkBucketWithoutCreds('s3scanner-throttled') is None
+    assert len(heads) == s3.SLOWDOWN_RETRIES
+
+    # checkBucketwcThrottled.2
+    assert s3.checkBucketWithoutCreds('s3scanner-throttled') is None
+    assert len(heads) == 2 * s3.SLOWDOWN_RETRIES
+
+    # checkBucketwcThrottled.3
+    messages = []
+
+    class RecordHandler(logging.Handler):
+        def emit(self, record):
+            messages.append(record.getMessage())
+
+    slog = logging.getLogger('s3scanner-screen-throttled')
+    slog.setLevel(logging.DEBUG)
+    slog.addHandler(RecordHandler())
+    flog = logging.getLogger('s3scanner-file-throttled')
+
+    s3.checkBucket('s3scanner-throttled', slog, flog, False, False)
+    assert len(messages) == 1
+    assert messages[0].startswith("[throttled] : s3scanner-throttled")
+
+
 def test_dumpBucket():
     """
     Scenario dumpBucket.1 - Public read permission enabled